@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+'''Tests the compact track file codec: varints, zigzag, run lengths and
+a track written by CompactWriter read back
+
+    python test_compact.py
+'''
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import gb580
+from gb580 import Utilities
+from pytz import utc
+
+
+def make_track(count, interval):
+    '''A GB580 of count points, interval seconds apart, in two laps'''
+    gb = gb580.GB580({'noalti':False})
+    gb.start_time = datetime.datetime(2014, 3, 14, 8, 0, 0, tzinfo=utc)
+    for n in range(count):
+        tp = gb580.TrackPoint()
+        tp.latitude, tp.longitude = 47.5 + n * 1e-5, -19.0 - n * 2e-6
+        tp.altitude = 100 + n % 7 - 3
+        tp.speed = 20 + n % 11 * 0.37
+        tp.hr = 120 + n / 50
+        tp.cadence = 85 if n % 200 < 150 else 0
+        tp.power_cad, tp.power = 0, 180 + n % 3
+        tp.interval_time = interval if n else 0.0
+        tp.time = gb.start_time + datetime.timedelta(seconds = n * interval)
+        tp.timestamp = tp.time.strftime('%Y-%m-%dT%H:%M:%SZ')
+        gb.track_points.append(tp)
+    for first, last in ((0, count / 2), (count / 2, count)):
+        lap = gb580.TrackLap()
+        lap.start_pt_index, lap.end_pt_index = first, last
+        lap.fill_stats(gb.track_points)
+        lap.end_time = (last - 1) * interval
+        gb.track_laps.append(lap)
+    gb.process_track_stats()
+    return gb
+
+
+class CodecTest(unittest.TestCase):
+
+    VALUES = [0, 1, 127, 128, 300, 16383, 16384, 2 ** 32 - 1, 2 ** 40]
+
+    def test_varints(self):
+        data = Utilities.write_varints(bytearray([0xAA]), self.VALUES)
+        self.assertEqual(data[:4], bytearray([0xAA, 0, 1, 127]))
+        self.assertEqual(Utilities.read_varints(data, 1, len(self.VALUES)),
+                         (self.VALUES, len(data)))
+
+    def test_zigzag(self):
+        signed = [0, -1, 1, -2, 2, -64, 64, -2 ** 31, 2 ** 31 - 1]
+        self.assertEqual(Utilities.zigzag(signed[:5]), [0, 1, 2, 3, 4])
+        self.assertEqual(Utilities.undo_zigzag(Utilities.zigzag(signed)), signed)
+        self.assertEqual(Utilities.undo_zigzag_deltas(
+            Utilities.zigzag_deltas(signed)), signed)
+
+    def test_run_lengths(self):
+        values = [0, 0, 0, 120, 121, 121, 0]
+        pairs = Utilities.run_lengths(values)
+        self.assertEqual(pairs, [0, 3, 120, 1, 121, 2, 0, 1])
+        self.assertEqual(Utilities.undo_run_lengths(pairs), values)
+        self.assertEqual(Utilities.run_lengths([]), [])
+
+
+class CompactFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'track.gbt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def round_trip(self, gb):
+        writer = gb580.CompactWriter(gb, open(self.filename, 'wb'))
+        gb.write_outputs([writer])
+        writer.outputfile.close()
+        back = gb580.GB580({'noalti':False})
+        back.read_track_file(self.filename)
+        return back
+
+    def test_round_trip(self):
+        gb = make_track(1000, 1.0)
+        back = self.round_trip(gb)
+        self.assertEqual(back.start_time, gb.start_time)
+        for field in ('latitude', 'longitude', 'altitude', 'hr', 'cadence',
+                      'power', 'interval_time', 'timestamp'):
+            self.assertEqual([getattr(tp, field) for tp in back.track_points],
+                             [getattr(tp, field) for tp in gb.track_points], field)
+        self.assertEqual([round(tp.speed, 2) for tp in back.track_points],
+                         [round(tp.speed, 2) for tp in gb.track_points])
+        for field, scale in gb580.COMPACT_TRACK_STATS:
+            self.assertAlmostEqual(getattr(back, field), getattr(gb, field),
+                                   delta = 0.5 / scale, msg = field)
+        self.assertEqual(len(back.track_laps), 2)
+        for lap, lap_back in zip(gb.track_laps, back.track_laps):
+            for field, scale in gb580.COMPACT_LAP_STATS:
+                self.assertAlmostEqual(getattr(lap_back, field),
+                    getattr(lap, field), delta = 0.5 / scale, msg = field)
+
+    def test_sub_tenth_intervals(self):
+        '''Rounding errors of 0.25s intervals do not add up'''
+        gb = make_track(4001, 0.25)
+        back = self.round_trip(gb)
+        self.assertEqual(back.track_points[-1].timestamp, '2014-03-14T08:16:40Z')
+        self.assertEqual(back.track_points[-1].time, gb.track_points[-1].time)
+        self.assertAlmostEqual(sum(tp.interval_time for tp in back.track_points),
+                               1000.0)
+        self.assertEqual(back.total_time, 1000.0)
+
+    def test_negative_interval(self):
+        gb = make_track(10, 1.0)
+        gb.track_points[5].interval_time = -2.0
+        back = self.round_trip(gb)
+        self.assertEqual(back.track_points[5].interval_time, -2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
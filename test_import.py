@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''Tests reading GPX and TCX files back into the track model
+
+    python test_import.py
+'''
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import gb580
+
+OPTS = {'noalti':False, 'output-format':'gpx'}
+
+ROUTE = '''<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="planner" xmlns="http://www.topografix.com/GPX/1/1">
+  <rte>
+    <rtept lat="47.50" lon="19.04"><ele>100</ele></rtept>
+    <rtept lat="47.51" lon="19.05"><ele>110</ele></rtept>
+    <rtept lat="47.52" lon="19.06"><ele>105</ele></rtept>
+  </rte>
+</gpx>
+'''
+
+COURSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">
+  <Courses>
+    <Course>
+      <Name>Loop</Name>
+      <Lap>
+        <TotalTimeSeconds>600</TotalTimeSeconds>
+        <DistanceMeters>2600</DistanceMeters>
+        <Intensity>Active</Intensity>
+      </Lap>
+      <Track>
+        <Trackpoint><Time>2014-03-14T08:00:00Z</Time>
+          <Position><LatitudeDegrees>47.50</LatitudeDegrees><LongitudeDegrees>19.04</LongitudeDegrees></Position>
+        </Trackpoint>
+        <Trackpoint><Time>2014-03-14T08:05:00Z</Time>
+          <Position><LatitudeDegrees>47.51</LatitudeDegrees><LongitudeDegrees>19.05</LongitudeDegrees></Position>
+        </Trackpoint>
+        <Trackpoint><Time>2014-03-14T08:10:00Z</Time>
+          <Position><LatitudeDegrees>47.52</LatitudeDegrees><LongitudeDegrees>19.06</LongitudeDegrees></Position>
+        </Trackpoint>
+      </Track>
+    </Course>
+  </Courses>
+</TrainingCenterDatabase>
+'''
+
+
+ZONES = '''<?xml version="1.0" encoding="UTF-8"?>
+<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">
+  <Activities>
+    <Activity Sport="Biking">
+      <Id>2014-03-14T10:00:00+02:00</Id>
+      <Lap StartTime="2014-03-14T10:00:00+02:00">
+        <Track>
+          <Trackpoint><Time>2014-03-14T10:00:00+02:00</Time>
+            <Position><LatitudeDegrees>47.50</LatitudeDegrees><LongitudeDegrees>19.04</LongitudeDegrees></Position>
+          </Trackpoint>
+          <Trackpoint><Time>2014-03-14T08:00:05</Time>
+            <Position><LatitudeDegrees>47.51</LatitudeDegrees><LongitudeDegrees>19.05</LongitudeDegrees></Position>
+          </Trackpoint>
+          <Trackpoint><Time>2014-03-14T08:00:10.000Z</Time>
+            <Position><LatitudeDegrees>47.52</LatitudeDegrees><LongitudeDegrees>19.06</LongitudeDegrees></Position>
+          </Trackpoint>
+        </Track>
+      </Lap>
+    </Activity>
+  </Activities>
+</TrainingCenterDatabase>
+'''
+
+
+class ImportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self, name, data):
+        filename = os.path.join(self.tmp, name)
+        open(filename, 'w').write(data)
+        gb = gb580.GB580(OPTS)
+        gb.read_track_file(filename)
+        return gb
+
+    def write(self, gb, extension):
+        filename = os.path.join(self.tmp, 'out.' + extension)
+        writer = gb580.WRITERS[extension](gb, open(filename, 'wb'))
+        gb.write_outputs([writer])
+        writer.outputfile.close()
+        return open(filename, 'rb').read()
+
+    def test_route_without_times(self):
+        gb = self.read('route.gpx', ROUTE)
+        self.assertEqual(len(gb.track_points), 3)
+        for tp in gb.track_points:
+            self.assertEqual(tp.time, gb.start_time)
+            self.assertEqual(tp.timestamp,
+                             gb.start_time.strftime('%Y-%m-%dT%H:%M:%SZ'))
+        for extension in ('gpx', 'tcx', 'csv'):
+            self.assertFalse('None' in self.write(gb, extension), extension)
+        self.assertTrue(self.write(gb, 'fit'))
+
+    def test_course_lap_before_track(self):
+        gb = self.read('course.tcx', COURSE)
+        self.assertEqual(len(gb.track_points), 3)
+        self.assertEqual(len(gb.track_laps), 1)
+        lap = gb.track_laps[0]
+        self.assertEqual((lap.start_pt_index, lap.end_pt_index), (0, 3))
+        self.assertEqual(lap.lap_time, 600.0)
+        self.assertEqual(self.write(gb, 'tcx').count('<Trackpoint>'), 3)
+
+    def test_time_zones(self):
+        gb = self.read('zones.tcx', ZONES)
+        self.assertEqual([tp.timestamp for tp in gb.track_points],
+            ['2014-03-14T08:00:00Z', '2014-03-14T08:00:05Z',
+             '2014-03-14T08:00:10Z'])
+        self.assertEqual([tp.interval_time for tp in gb.track_points],
+                         [0.0, 5.0, 5.0])
+        self.assertEqual(gb.start_time.utcoffset(), datetime.timedelta(0))
+        self.assertEqual(gb.start_time.hour, 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+'''Tests UploadQueue against a local stub of an activity service
+
+    python test_upload.py
+'''
+
+import BaseHTTPServer
+import SocketServer
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import zlib
+
+import gb580
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answers 503 once to keys ending in "retry", 400 to "bad", 409 to
+    "dup" and 201 to the rest, keeping what it was sent'''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        key = self.headers['Idempotency-Key']
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.requests += 1
+            if key.endswith('retry') and key not in server.retried:
+                server.retried.add(key)
+                code = 503
+            elif key.endswith('bad'):
+                code = 400
+            elif key.endswith('dup'):
+                code = 409
+            else:
+                server.bodies[key] = (self.headers['Content-Type'],
+                    zlib.decompress(body, 16 + zlib.MAX_WBITS))
+                code = 201
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.connections = set()
+        self.retried = set()
+        self.bodies = {}
+        self.requests = 0
+
+
+class UploadQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.tmp = tempfile.mkdtemp()
+        self.queue = gb580.UploadQueue(os.path.join(self.tmp, 'queue'),
+            'http://127.0.0.1:%d/activities' % self.server.server_address[1],
+            jobs=2, backoff=0.01)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def add(self, name, data, extension, key):
+        filename = os.path.join(self.tmp, name)
+        open(filename, 'w').write(data)
+        self.queue.add(filename, extension, key)
+        return filename
+
+    def queued(self):
+        return sorted(os.listdir(self.queue.directory))
+
+    def test_keep_alive(self):
+        for day in range(1, 21):
+            start = datetime.datetime(2014, 3, day, 8, 0, 0)
+            self.add('%d.gpx' % day, '<gpx>%d</gpx>' % day, 'gpx',
+                     gb580.UploadQueue.idempotency_key(start, 'gpx'))
+        self.assertEqual(self.queue.drain(), 20)
+        self.assertEqual(self.queued(), [])
+        self.assertEqual(self.server.requests, 20)
+        self.assertEqual(len(self.server.connections), 2)
+        self.assertEqual(self.server.bodies['gb580-20140305T080000-gpx'],
+                         ('application/gpx+xml', '<gpx>5</gpx>'))
+
+    def test_statuses(self):
+        self.add('a.csv', 'a,b', 'csv', 'k-retry')
+        self.add('b.gpx', '<gpx/>', 'gpx', 'k-bad')
+        self.add('c.gpx', '<gpx/>', 'gpx', 'k-dup')
+        self.assertEqual(self.queue.drain(), 2)
+        self.assertEqual(self.server.bodies['k-retry'], ('text/csv', 'a,b'))
+        self.assertEqual(self.queued(), ['k-bad.failed'])
+
+    def test_format_of_numbered_file(self):
+        start = datetime.datetime(2014, 3, 14, 8, 42, 47)
+        key = gb580.UploadQueue.idempotency_key(start, 'gpx')
+        self.add('20140314.gpx_1', '<gpx/>', 'gpx', key)
+        self.queue.drain()
+        self.assertEqual(key, 'gb580-20140314T084247-gpx')
+        self.assertEqual(self.server.bodies[key][0], 'application/gpx+xml')
+
+    def test_unreadable_entries(self):
+        os.remove(self.add('gone.gpx', '<gpx/>', 'gpx', 'k-gone'))
+        open(os.path.join(self.queue.directory, 'k-torn.json'), 'w').write('{"fi')
+        self.add('ok.gpx', '<gpx/>', 'gpx', 'k-ok')
+        self.assertEqual(self.queue.drain(), 1)
+        self.assertEqual(self.queue.failed, 2)
+        self.assertEqual(self.queued(), ['k-gone.failed', 'k-torn.failed'])
+        self.assertTrue('k-ok' in self.server.bodies)
+
+
+if __name__ == '__main__':
+    unittest.main()